@@ -409,6 +409,9 @@ def main() -> None:
     # NOTE: デフォルトは ASGI に準拠した HTTP/1.1 サーバー
     uvicorn.run(app, host=args.host, port=args.port)
 
+    # 予約済みのユーザー辞書更新を終えてから終了する
+    user_dict.close()
+
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,18 @@
 """ユーザー辞書の単体テスト。"""
 
 import json
+import shutil
+import warnings
 from copy import deepcopy
 from pathlib import Path
+from threading import Thread
+from unittest.mock import patch
 
+import pyopenjtalk
 import pytest
 from pyopenjtalk import g2p, unset_user_dict
 
+from voicevox_engine.user_dict import user_dict_manager
 from voicevox_engine.user_dict.model import (
     USER_DICT_MAX_PRIORITY,
     UserDictWord,
@@ -78,6 +84,37 @@ def test_read_not_exist_json(tmp_path: Path) -> None:
     assert user_dict.read_dict() == {}
 
 
+def test_read_dict_after_external_update(tmp_path: Path) -> None:
+    user_dict_path = tmp_path / "test_read_dict_after_external_update.json"
+    user_dict_path.write_text(
+        json.dumps(valid_dict_dict_json, ensure_ascii=False), encoding="utf-8"
+    )
+    user_dict = UserDictionary(user_dict_path=user_dict_path)
+    assert len(user_dict.read_dict()) == 1
+
+    # 読み出し済みのファイルを外部から書き換える
+    user_dict_path.write_text("{}", encoding="utf-8")
+    assert user_dict.read_dict() == {}
+
+
+def test_read_dict_returns_independent_words(tmp_path: Path) -> None:
+    user_dict_path = tmp_path / "test_read_dict_returns_independent_words.json"
+    user_dict_path.write_text(
+        json.dumps(valid_dict_dict_json, ensure_ascii=False), encoding="utf-8"
+    )
+    user_dict = UserDictionary(user_dict_path=user_dict_path)
+
+    # 読み出した単語を書き換えても、以降の読み出し結果は変わらない
+    word = user_dict.read_dict()["aab7dda2-0d97-43c8-8cb7-3f440dab9b4e"]
+    word.priority = 0
+    assert user_dict.read_dict()["aab7dda2-0d97-43c8-8cb7-3f440dab9b4e"].priority == 5
+
+
+def test_read_dict_from_directory(tmp_path: Path) -> None:
+    user_dict = UserDictionary(user_dict_path=tmp_path)
+    assert user_dict.read_dict() == {}
+
+
 def test_create_word() -> None:
     # 将来的に品詞などが追加された時にテストを増やす
     assert create_word(
@@ -187,6 +224,21 @@ def test_delete_word_valid_id(tmp_path: Path) -> None:
     assert len(user_dict.read_dict()) == 0
 
 
+def test_write_in_place_modified_word(tmp_path: Path) -> None:
+    user_dict_path = tmp_path / "test_write_in_place_modified_word.json"
+    user_dict_path.write_text(
+        json.dumps(valid_dict_dict_json, ensure_ascii=False), encoding="utf-8"
+    )
+    user_dict = UserDictionary(user_dict_path=user_dict_path)
+    words = {"b1affe2a-d5f0-4050-926c-f28e0c1d9a98": deepcopy(import_word)}
+    user_dict.import_user_dict(words, override=True)
+
+    # 保存済みの単語オブジェクトをその場で書き換えて再度保存すると、変更が反映される
+    words["b1affe2a-d5f0-4050-926c-f28e0c1d9a98"].priority = 0
+    user_dict.import_user_dict(words, override=True)
+    assert user_dict.read_dict()["b1affe2a-d5f0-4050-926c-f28e0c1d9a98"].priority == 0
+
+
 def test_priority() -> None:
     for pos in part_of_speech_data:
         for i in range(USER_DICT_MAX_PRIORITY + 1):
@@ -253,13 +305,20 @@ def test_import_invalid_word(tmp_path: Path) -> None:
         json.dumps(valid_dict_dict_json, ensure_ascii=False), encoding="utf-8"
     )
     user_dict = UserDictionary(user_dict_path=user_dict_path)
-    with pytest.raises(AssertionError):
+    with pytest.raises(ValueError):
         user_dict.import_user_dict(
             {
                 "aab7dda2-0d97-43c8-8cb7-3f440dab9b4e": invalid_accent_associative_rule_word
             },
             override=True,
         )
+    mismatched_pos_word = deepcopy(import_word)
+    mismatched_pos_word.part_of_speech = "動詞"
+    with pytest.raises(ValueError):
+        user_dict.import_user_dict(
+            {"aab7dda2-0d97-43c8-8cb7-3f440dab9b4e": mismatched_pos_word},
+            override=True,
+        )
     invalid_pos_word = deepcopy(import_word)
     invalid_pos_word.context_id = 2
     invalid_pos_word.part_of_speech = "フィラー"
@@ -273,10 +332,11 @@ def test_import_invalid_word(tmp_path: Path) -> None:
         )
 
 
-def test_update_dict(tmp_path: Path) -> None:
+def test_update_dict(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
     user_dict_path = tmp_path / "test_update_dict.json"
     user_dict = UserDictionary(user_dict_path=user_dict_path)
     user_dict.update_dict()
+    user_dict.wait_for_updates()
     test_text = "テスト用の文字列"
     success_pronunciation = "デフォルトノジショデハゼッタイニセイセイサレナイヨミ"
 
@@ -291,10 +351,157 @@ def test_update_dict(tmp_path: Path) -> None:
             priority=10,
         )
     )
+    user_dict.wait_for_updates()
     assert g2p(text=test_text, kana=True) == success_pronunciation
 
     # 疑似的にエンジンを再起動する
     unset_user_dict()
+    monkeypatch.setattr(user_dict_manager, "_loaded_csv_hash", None)
     user_dict.update_dict()
+    user_dict.wait_for_updates()
+
+    assert g2p(text=test_text, kana=True) == success_pronunciation
+
+
+def test_batch_update_dict(tmp_path: Path) -> None:
+    user_dict_path = tmp_path / "test_batch_update_dict.json"
+    user_dict = UserDictionary(user_dict_path=user_dict_path)
+    test_text = "バッチ用の文字列"
+    success_pronunciation = "デフォルトノジショデハゼッタイニセイセイサレナイヨミ"
+
+    with user_dict.batch():
+        user_dict.apply_word(
+            WordProperty(
+                surface=test_text,
+                pronunciation=success_pronunciation,
+                accent_type=1,
+                priority=10,
+            )
+        )
+        # ブロック内では辞書の更新が遅延される
+        user_dict.wait_for_updates()
+        assert g2p(text=test_text, kana=True) != success_pronunciation
+
+        # 他スレッドからの更新は遅延されない
+        other_text = "別スレッド用の文字列"
+        thread = Thread(
+            target=user_dict.apply_word,
+            args=(
+                WordProperty(
+                    surface=other_text,
+                    pronunciation=success_pronunciation,
+                    accent_type=1,
+                    priority=10,
+                ),
+            ),
+        )
+        thread.start()
+        thread.join()
+        user_dict.wait_for_updates()
+        assert g2p(text=other_text, kana=True) == success_pronunciation
+
+    user_dict.wait_for_updates()
+    assert g2p(text=test_text, kana=True) == success_pronunciation
+
+
+def test_update_dict_recreates_tmp_dir(tmp_path: Path) -> None:
+    user_dict_path = tmp_path / "test_update_dict_recreates_tmp_dir.json"
+    user_dict = UserDictionary(user_dict_path=user_dict_path)
+    test_text = "一時ディレクトリ用の文字列"
+    success_pronunciation = "デフォルトノジショデハゼッタイニセイセイサレナイヨミ"
+
+    # 稼働中に一時ディレクトリが削除されても辞書を更新できる
+    shutil.rmtree(user_dict_manager._TMP_DIR)
+    user_dict.apply_word(
+        WordProperty(
+            surface=test_text,
+            pronunciation=success_pronunciation,
+            accent_type=1,
+            priority=10,
+        )
+    )
+    user_dict.wait_for_updates()
+    assert g2p(text=test_text, kana=True) == success_pronunciation
+
 
+def test_batch_keeps_body_error(tmp_path: Path) -> None:
+    user_dict_path = tmp_path / "test_batch_keeps_body_error.json"
+    user_dict = UserDictionary(user_dict_path=user_dict_path)
+
+    # ブロック内の例外は、遅延された辞書更新の失敗で置き換えられない
+    with patch.object(pyopenjtalk, "mecab_dict_index"):
+        with pytest.warns(UserWarning, match="Failed to update the user dictionary"):
+            with pytest.raises(ValueError, match="batch body"):
+                with user_dict.batch():
+                    user_dict.apply_word(
+                        WordProperty(
+                            surface="test", pronunciation="テスト", accent_type=1
+                        )
+                    )
+                    raise ValueError("batch body")
+            user_dict.close()
+
+
+def test_update_dict_skips_unchanged_compile(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    user_dict_path = tmp_path / "test_update_dict_skips_unchanged_compile.json"
+    user_dict = UserDictionary(user_dict_path=user_dict_path)
+    test_text = "再利用用の文字列"
+    success_pronunciation = "デフォルトノジショデハゼッタイニセイセイサレナイヨミ"
+    word_property = WordProperty(
+        surface=test_text,
+        pronunciation=success_pronunciation,
+        accent_type=1,
+        priority=10,
+    )
+    word_uuid = user_dict.apply_word(word_property)
+    user_dict.wait_for_updates()
+
+    # 辞書の内容が変わらない更新では再コンパイルされない
+    with patch.object(
+        pyopenjtalk, "mecab_dict_index", wraps=pyopenjtalk.mecab_dict_index
+    ) as mecab_dict_index:
+        user_dict.rewrite_word(word_uuid, word_property)
+        user_dict.wait_for_updates()
+        user_dict.update_dict()
+        user_dict.wait_for_updates()
+        UserDictionary(user_dict_path=user_dict_path)
+        mecab_dict_index.assert_not_called()
+
+        # 疑似的にエンジンを再起動すると、読み込まれていない辞書をコンパイルし直す
+        unset_user_dict()
+        monkeypatch.setattr(user_dict_manager, "_loaded_csv_hash", None)
+        user_dict.update_dict()
+        user_dict.wait_for_updates()
+        mecab_dict_index.assert_called_once()
     assert g2p(text=test_text, kana=True) == success_pronunciation
+
+
+def test_wait_for_updates_raises_compile_error(tmp_path: Path) -> None:
+    user_dict_path = tmp_path / "test_wait_for_updates_raises_compile_error.json"
+    user_dict = UserDictionary(user_dict_path=user_dict_path)
+
+    # コンパイル済み辞書が生成されない場合、バックグラウンドでのエラーが完了を待つ呼び出し元へ伝わる
+    with patch.object(pyopenjtalk, "mecab_dict_index"):
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            user_dict.apply_word(
+                WordProperty(surface="test", pronunciation="テスト", accent_type=1)
+            )
+            with pytest.raises(RuntimeError):
+                user_dict.wait_for_updates()
+    user_dict.close()
+
+
+def test_unawaited_compile_error_warns(tmp_path: Path) -> None:
+    user_dict_path = tmp_path / "test_unawaited_compile_error_warns.json"
+    user_dict = UserDictionary(user_dict_path=user_dict_path)
+
+    # 誰も完了を待っていないコンパイルのエラーは警告される
+    with patch.object(pyopenjtalk, "mecab_dict_index"):
+        with pytest.warns(UserWarning, match="Failed to update the user dictionary"):
+            user_dict.apply_word(
+                WordProperty(surface="test", pronunciation="テスト", accent_type=1)
+            )
+            user_dict.close()
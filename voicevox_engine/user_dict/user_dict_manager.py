@@ -1,12 +1,17 @@
 """ユーザー辞書関連の処理"""
 
-import json
+import atexit
+import hashlib
+import shutil
 import sys
+import tempfile
 import threading
 import warnings
-from collections.abc import Callable
+from collections.abc import Iterator
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Final, TypeVar
+from typing import Final
 from uuid import UUID, uuid4
 
 import pyopenjtalk
@@ -25,23 +30,6 @@ from .user_dict_word import (
     priority2cost,
 )
 
-F = TypeVar("F", bound=Callable[..., Any])
-
-
-def _mutex_wrapper(lock: threading.Lock) -> Callable[[F], F]:
-    def wrap(f: F) -> F:
-        def func(*args: Any, **kw: Any) -> Any:
-            lock.acquire()
-            try:
-                return f(*args, **kw)
-            finally:
-                lock.release()
-
-        return func  # type: ignore
-
-    return wrap
-
-
 resource_dir = resource_root()
 save_dir = get_save_dir()
 
@@ -52,13 +40,75 @@ if not save_dir.is_dir():
 DEFAULT_DICT_PATH: Final = resource_dir / "default.csv"  # VOICEVOXデフォルト辞書
 _USER_DICT_PATH: Final = save_dir / "user_dict.json"  # ユーザー辞書
 
+# 辞書コンパイル時の一時ファイルを置くディレクトリ。プロセス内で使い回し、終了時に削除する。
+_TMP_DIR: Final = Path(tempfile.mkdtemp(prefix="voicevox_user_dict-"))
+
 
 # 同時書き込みの制御
 mutex_user_dict = threading.Lock()
 mutex_openjtalk_dict = threading.Lock()
 
 
-_save_format_dict_adapter = TypeAdapter(dict[str, SaveFormatUserDictWord])
+# OpenJTalk に読み込まれている辞書.csvのハッシュ。OpenJTalk の辞書はプロセス全体で共有されるため、モジュールで持つ。
+# NOTE: ユーザー辞書の読み込みと解除はこのモジュールからのみ行い、読み込まれていない間は None とする
+_loaded_csv_hash: bytes | None = None
+
+
+def _remove_tmp_dir() -> None:
+    """
+    一時ディレクトリを削除する。
+
+    Windows では読み込み中のコンパイル済み辞書のハンドルが閉じるまでファイルが残り、ディレクトリを削除できない。
+    そのため、先にユーザー辞書の読み込みを解除してハンドルを閉じる。
+    """
+    global _loaded_csv_hash
+
+    with mutex_openjtalk_dict:
+        # NOTE: 辞書を読み込んでいないプロセスで OpenJTalk を初期化させないよう、読み込み済みの場合のみ解除する
+        if _loaded_csv_hash is not None:
+            pyopenjtalk.unset_user_dict()
+            _loaded_csv_hash = None
+    shutil.rmtree(_TMP_DIR, ignore_errors=True)
+
+
+atexit.register(_remove_tmp_dir)
+
+
+_save_format_dict_adapter: Final = TypeAdapter(dict[str, SaveFormatUserDictWord])
+_DUMP_SAVE_FORMAT_DICT_JSON: Final = _save_format_dict_adapter.dump_json
+
+# 文脈IDから品詞情報・アクセント結合規則を引くための表
+_POS_BY_CONTEXT_ID: Final = {
+    pos_detail.context_id: pos_detail for pos_detail in part_of_speech_data.values()
+}
+_POS_RULES_BY_CONTEXT_ID: Final = {
+    context_id: frozenset(pos_detail.accent_associative_rules)
+    for context_id, pos_detail in _POS_BY_CONTEXT_ID.items()
+}
+
+
+def _convert_to_save_format_with_cache(
+    word: UserDictWord,
+    cached: tuple[UserDictWord, SaveFormatUserDictWord] | None,
+) -> tuple[UserDictWord, SaveFormatUserDictWord]:
+    """前回保存時と内容が等しい単語であれば変換結果を再利用し、そうでなければ保存用に変換する。"""
+    # NOTE: 単語はその場で書き換えられうるため、同一性ではなく保存時に複製した単語との値の等価性で判定する
+    if cached is not None and cached[0] == word:
+        return cached
+    return word.model_copy(), convert_to_save_format(word)
+
+
+class _BatchState(threading.local):
+    """スレッドごとの `UserDictionary.batch()` の状態"""
+
+    def __init__(self) -> None:
+        self.depth = 0  # batch() のネスト数
+        self.pending_update = False  # batch() 内で遅延された辞書更新の有無
+
+
+def _copy_words(user_dict: dict[str, UserDictWord]) -> dict[str, UserDictWord]:
+    """単語オブジェクトごと複製した辞書を返す。スナップショットが呼び出し元の書き換えの影響を受けないようにする。"""
+    return {word_uuid: word.model_copy() for word_uuid, word in user_dict.items()}
 
 
 def _delete_file_on_close(file_path: Path) -> None:
@@ -138,108 +188,293 @@ class UserDictionary:
         """
         self._default_dict_path = default_dict_path
         self._user_dict_path = user_dict_path
+        # 最後に読み書きしたユーザー辞書のスナップショット。キーはファイルの (更新時刻, サイズ)。
+        self._cache: tuple[tuple[int, int], dict[str, UserDictWord]] | None = None
+        # 単語 UUID ごとの、直近に保存した単語の複製とその保存用形式
+        self._save_format_cache: dict[
+            str, tuple[UserDictWord, SaveFormatUserDictWord]
+        ] = {}
+        # `batch()` の状態。他スレッドの辞書更新を遅延させないよう、スレッドごとに持つ。
+        self._batch_state = _BatchState()
+        # ユーザー辞書ファイルへの書き込みごとに増える版番号と、OpenJTalk へ反映済みの版番号
+        self._written_version = 0
+        self._compiled_version = 0
+        # 辞書のコンパイルを担うワーカーと、最後に予約したコンパイル、`wait_for_updates()` で完了を待たれているコンパイル
+        self._compile_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="user_dict_compile"
+        )
+        self._pending_future: Future[None] | None = None
+        self._awaited_futures: set[Future[None]] = set()
+        # NOTE: 取り消しや完了済みの予約へのコールバック登録では、ロックを保持したスレッドでコールバックが呼ばれるため再入可能にする
+        self._schedule_lock = threading.RLock()
+
+        # 起動直後から辞書が使えるよう、初回のコンパイルは完了まで待つ
         self.update_dict()
+        self.wait_for_updates()
 
-    @_mutex_wrapper(mutex_user_dict)
-    def _write_to_json(self, user_dict: dict[str, UserDictWord]) -> None:
-        """ユーザー辞書データをファイルへ書き込む。"""
-        save_format_user_dict: dict[str, SaveFormatUserDictWord] = {}
-        for word_uuid, word in user_dict.items():
-            save_format_word = convert_to_save_format(word)
-            save_format_user_dict[word_uuid] = save_format_word
-        user_dict_json = _save_format_dict_adapter.dump_json(save_format_user_dict)
-        self._user_dict_path.write_bytes(user_dict_json)
-
-    @_mutex_wrapper(mutex_openjtalk_dict)
-    def update_dict(self) -> None:
-        """辞書を更新する。"""
-        default_dict_path = self._default_dict_path
-        user_dict_path = self._user_dict_path
-
-        random_string = uuid4()
-        tmp_csv_path = user_dict_path.with_name(
-            f"user.dict_csv-{random_string}.tmp"
-        )  # csv形式辞書データの一時保存ファイル
-        tmp_compiled_path = user_dict_path.with_name(
-            f"user.dict_compiled-{random_string}.tmp"
-        )  # コンパイル済み辞書データの一時保存ファイル
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        ブロック内で要求された辞書更新をまとめ、ブロックを抜ける際に一度だけ実行する。
 
+        単語を連続して追加・更新・削除する際に、辞書のコンパイルが毎回走るのを避けられる。
+        遅延されるのは呼び出したスレッドからの更新のみである。
+        """
+        state = self._batch_state
+        state.depth += 1
         try:
-            # 辞書.csvを作成
-            csv_text = ""
-
-            # デフォルト辞書データの追加
-            if not default_dict_path.is_file():
-                warnings.warn("Cannot find default dictionary.", stacklevel=1)
-                return
-            default_dict = default_dict_path.read_text(encoding="utf-8")
-            if default_dict == default_dict.rstrip():
-                default_dict += "\n"
-            csv_text += default_dict
-
-            # ユーザー辞書データの追加
-            user_dict = self.read_dict()
-            for word_uuid in user_dict:
-                word = user_dict[word_uuid]
-                csv_text += (
-                    "{surface},{context_id},{context_id},{cost},{part_of_speech},"
-                    + "{part_of_speech_detail_1},{part_of_speech_detail_2},"
-                    + "{part_of_speech_detail_3},{inflectional_type},"
-                    + "{inflectional_form},{stem},{yomi},{pronunciation},"
-                    + "{accent_type}/{mora_count},{accent_associative_rule}\n"
-                ).format(
-                    surface=word.surface,
-                    context_id=word.context_id,
-                    cost=priority2cost(word.context_id, word.priority),
-                    part_of_speech=word.part_of_speech,
-                    part_of_speech_detail_1=word.part_of_speech_detail_1,
-                    part_of_speech_detail_2=word.part_of_speech_detail_2,
-                    part_of_speech_detail_3=word.part_of_speech_detail_3,
-                    inflectional_type=word.inflectional_type,
-                    inflectional_form=word.inflectional_form,
-                    stem=word.stem,
-                    yomi=word.yomi,
-                    pronunciation=word.pronunciation,
-                    accent_type=word.accent_type,
-                    mora_count=word.mora_count,
-                    accent_associative_rule=word.accent_associative_rule,
+            yield
+        finally:
+            state.depth -= 1
+            if state.depth == 0 and state.pending_update:
+                state.pending_update = False
+                # NOTE: 完了は待たないため、コンパイルの失敗がブロック内で送出された例外を置き換えることはない
+                self._request_update(None, self._written_version)
+
+    def _write_to_json(self, user_dict: dict[str, UserDictWord]) -> int:
+        """ユーザー辞書データをファイルへ書き込み、書き込んだ内容の版番号を返す。"""
+        with mutex_user_dict:
+            previous_cache = self._save_format_cache
+            save_format_cache = {
+                word_uuid: _convert_to_save_format_with_cache(
+                    word, previous_cache.get(word_uuid)
                 )
-            # 辞書データを辞書.csv へ一時保存
-            tmp_csv_path.write_text(csv_text, encoding="utf-8")
+                for word_uuid, word in user_dict.items()
+            }
+            # 削除された単語のエントリは新しいキャッシュに含まれない
+            self._save_format_cache = save_format_cache
+            save_format_user_dict = {
+                word_uuid: save_format_word
+                for word_uuid, (_, save_format_word) in save_format_cache.items()
+            }
+            user_dict_json = _DUMP_SAVE_FORMAT_DICT_JSON(save_format_user_dict)
+            self._user_dict_path.write_bytes(user_dict_json)
+
+            # 書き込んだ内容でスナップショットを差し替え、読み出し時の再パースを省く
+            # NOTE: 単語はキャッシュが保持する複製を共有し、キーは前回のスナップショットに無いものだけ正規化する
+            previous_words = self._cache[1] if self._cache is not None else {}
+            stat = self._user_dict_path.stat()
+            self._cache = (
+                (stat.st_mtime_ns, stat.st_size),
+                {
+                    (
+                        word_uuid
+                        if word_uuid in previous_words
+                        else str(UUID(word_uuid))
+                    ): saved_word
+                    for word_uuid, (saved_word, _) in save_format_cache.items()
+                },
+            )
+            self._written_version += 1
+            return self._written_version
 
-            # 辞書.csvをOpenJTalk用にコンパイル
-            pyopenjtalk.mecab_dict_index(str(tmp_csv_path), str(tmp_compiled_path))
-            if not tmp_compiled_path.is_file():
-                raise RuntimeError("辞書のコンパイル時にエラーが発生しました。")
+    def update_dict(self) -> None:
+        """
+        ユーザー辞書ファイルの内容で辞書の更新を予約する。`batch()` 内で呼ばれた場合は予約をブロックの終わりまで遅延する。
 
-            # コンパイル済み辞書の読み込み
-            pyopenjtalk.update_global_jtalk_with_user_dict(
-                str(tmp_compiled_path.resolve(strict=True))
-            )  # NOTE: resolveによりコンパイル実行時でも相対パスを正しく認識できる
+        コンパイルはバックグラウンドで行われ、未着手の古い予約は新しい予約で置き換えられる。
+        単語の追加・更新・削除やインポートも同様に、コンパイルの完了を待たずに戻る。
+        完了を待つ場合は `wait_for_updates()` を呼ぶ。誰も完了を待っていないコンパイルが失敗した場合は警告する。
+        """
+        self._request_update(None, None)
 
-        except Exception as e:
-            raise e
+    def _request_update(
+        self, user_dict: dict[str, UserDictWord] | None, version: int | None
+    ) -> None:
+        """
+        辞書の更新を予約する。`batch()` 内であれば予約をブロックの終わりまで遅延する。
 
-        finally:
-            # 後処理
-            if tmp_csv_path.exists():
-                tmp_csv_path.unlink()
-            if tmp_compiled_path.exists():
-                _delete_file_on_close(tmp_compiled_path)
+        Parameters
+        ----------
+        user_dict : dict[str, UserDictWord] | None
+            適用するユーザー辞書のデータ。None の場合はコンパイル時にファイルから読み出す。
+        version : int | None
+            `user_dict` を書き込んだ際の版番号。None の場合は版番号による比較を行わない。
+        """
+        state = self._batch_state
+        if state.depth > 0:
+            state.pending_update = True
+            return
+
+        with self._schedule_lock:
+            if self._pending_future is not None:
+                self._pending_future.cancel()
+            future = self._compile_executor.submit(
+                self._compile_and_load, user_dict, version
+            )
+            future.add_done_callback(self._warn_unawaited_compile_error)
+            self._pending_future = future
+
+    def _warn_unawaited_compile_error(self, future: Future[None]) -> None:
+        """完了を待つ呼び出し元がいないコンパイルが失敗していれば、エラーを見失わないよう警告する。"""
+        with self._schedule_lock:
+            awaited = future in self._awaited_futures
+            self._awaited_futures.discard(future)
+        if awaited or future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            warnings.warn(
+                f"Failed to update the user dictionary: {error!r}", stacklevel=1
+            )
+
+    def wait_for_updates(self) -> None:
+        """予約済みの辞書更新の完了を待つ。更新に失敗していた場合はその例外を送出する。"""
+        while True:
+            with self._schedule_lock:
+                future = self._pending_future
+                if future is None:
+                    return
+                # 完了済みのコンパイルの警告は発行済みか発行中のため、未完了のものだけ待機中として登録する
+                if not future.done():
+                    self._awaited_futures.add(future)
+            try:
+                future.result()
+            except CancelledError:
+                # 待機中に新しい予約で置き換えられたため、新しい予約の完了を待つ
+                continue
+            return
+
+    def close(self) -> None:
+        """予約済みの辞書更新の完了を待ち、コンパイル用のワーカーを終了する。"""
+        self._compile_executor.shutdown(wait=True)
+
+    def _compile_and_load(
+        self, user_dict: dict[str, UserDictWord] | None, version: int | None
+    ) -> None:
+        """辞書をコンパイルし、OpenJTalk へ読み込ませる。"""
+        global _loaded_csv_hash
+
+        with mutex_openjtalk_dict:
+            if version is not None:
+                # より新しい書き込みを反映済みであれば、古い内容で上書きしない
+                if version < self._compiled_version:
+                    return
+                # 予約後に別の書き込みがあった場合は、ファイルから最新の内容を読み直す
+                if version < self._written_version:
+                    user_dict = None
+            if user_dict is None:
+                # NOTE: 読み出される内容は、少なくとも読み出し前の版番号の書き込みを含む
+                version = self._written_version
+                user_dict = self.read_dict()
+
+            default_dict_path = self._default_dict_path
+
+            random_string = uuid4()
+            tmp_csv_path = (
+                _TMP_DIR / f"user.dict_csv-{random_string}.tmp"
+            )  # csv形式辞書データの一時保存ファイル
+            tmp_compiled_path = (
+                _TMP_DIR / f"user.dict_compiled-{random_string}.tmp"
+            )  # コンパイル済み辞書データの一時保存ファイル
+
+            try:
+                # 辞書.csvを作成
+                # NOTE: 文字列の逐次連結は単語数の二乗に比例するため、行をリストに溜めて最後に結合する
+                csv_rows: list[str] = []
+
+                # デフォルト辞書データの追加
+                if not default_dict_path.is_file():
+                    warnings.warn("Cannot find default dictionary.", stacklevel=1)
+                    return
+                default_dict = default_dict_path.read_text(encoding="utf-8")
+                if default_dict == default_dict.rstrip():
+                    default_dict += "\n"
+                csv_rows.append(default_dict)
+
+                # ユーザー辞書データの追加
+                for word in user_dict.values():
+                    context_id = str(word.context_id)
+                    cost = priority2cost(word.context_id, word.priority)
+                    csv_rows.append(
+                        ",".join(
+                            (
+                                word.surface,
+                                context_id,
+                                context_id,
+                                str(cost),
+                                word.part_of_speech,
+                                word.part_of_speech_detail_1,
+                                word.part_of_speech_detail_2,
+                                word.part_of_speech_detail_3,
+                                word.inflectional_type,
+                                word.inflectional_form,
+                                word.stem,
+                                word.yomi,
+                                word.pronunciation,
+                                f"{word.accent_type}/{word.mora_count}",
+                                f"{word.accent_associative_rule}\n",
+                            )
+                        )
+                    )
+                csv_bytes = "".join(csv_rows).encode("utf-8")
+
+                # 読み込み済みの辞書と内容が同じであれば、コンパイルと読み込みを省く
+                csv_hash = hashlib.blake2b(csv_bytes, digest_size=16).digest()
+                if version is not None and csv_hash == _loaded_csv_hash:
+                    self._compiled_version = version
+                    return
+
+                # 辞書データを辞書.csv へ一時保存
+                # NOTE: pyopenjtalk はファイルパスでしか辞書データを受け付けない
+                # NOTE: 長時間の稼働中に一時ディレクトリが OS の定期清掃で消されうるため、書き込みの度に作り直す
+                _TMP_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+                tmp_csv_path.write_bytes(csv_bytes)
+
+                # 辞書.csvをOpenJTalk用にコンパイル
+                pyopenjtalk.mecab_dict_index(str(tmp_csv_path), str(tmp_compiled_path))
+                if not tmp_compiled_path.is_file():
+                    raise RuntimeError("辞書のコンパイル時にエラーが発生しました。")
+
+                # コンパイル済み辞書の読み込み
+                pyopenjtalk.update_global_jtalk_with_user_dict(
+                    str(tmp_compiled_path.resolve(strict=True))
+                )  # NOTE: resolveによりコンパイル実行時でも相対パスを正しく認識できる
+                _loaded_csv_hash = csv_hash
+                if version is not None:
+                    self._compiled_version = version
+
+            except Exception as e:
+                raise e
+
+            finally:
+                # 後処理
+                if tmp_csv_path.exists():
+                    tmp_csv_path.unlink()
+                if tmp_compiled_path.exists():
+                    _delete_file_on_close(tmp_compiled_path)
 
-    @_mutex_wrapper(mutex_user_dict)
     def read_dict(self) -> dict[str, UserDictWord]:
-        """ユーザー辞書を読み出す。"""
+        """
+        ユーザー辞書を読み出す。
+
+        ファイルが前回の読み書きから変更されていなければ、ロックを取らずにスナップショットの複製を返す。
+        """
         # 指定ユーザー辞書が存在しない場合、空辞書を返す
         if not self._user_dict_path.is_file():
             return {}
-
-        with self._user_dict_path.open(encoding="utf-8") as f:
-            save_format_dict = _save_format_dict_adapter.validate_python(json.load(f))
-            result: dict[str, UserDictWord] = {}
-            for word_uuid, word in save_format_dict.items():
-                result[str(UUID(word_uuid))] = convert_from_save_format(word)
-        return result
+        file_stat = self._user_dict_path.stat()
+        file_key = (file_stat.st_mtime_ns, file_stat.st_size)
+
+        cache = self._cache
+        if cache is not None and cache[0] == file_key:
+            return _copy_words(cache[1])
+
+        with mutex_user_dict:
+            # ロック待ちの間に他スレッドが読み込み済みであれば、それを使う
+            cache = self._cache
+            if cache is not None and cache[0] == file_key:
+                return _copy_words(cache[1])
+
+            # NOTE: JSON を中間の Python オブジェクトへ変換せず、直接バリデーションする
+            raw = self._user_dict_path.read_bytes()
+            save_format_dict = _save_format_dict_adapter.validate_json(raw)
+            user_dict = {
+                str(UUID(word_uuid)): convert_from_save_format(word)
+                for word_uuid, word in save_format_dict.items()
+            }
+            self._cache = (file_key, user_dict)
+        return _copy_words(user_dict)
 
     def import_user_dict(
         self, dict_data: dict[str, UserDictWord], override: bool = False
@@ -257,28 +492,28 @@ class UserDictionary:
         # インポートする辞書データのバリデーション
         for word_uuid, word in dict_data.items():
             UUID(word_uuid)
-            for pos_detail in part_of_speech_data.values():
-                if word.context_id == pos_detail.context_id:
-                    assert word.part_of_speech == pos_detail.part_of_speech
-                    assert (
-                        word.part_of_speech_detail_1
-                        == pos_detail.part_of_speech_detail_1
-                    )
-                    assert (
-                        word.part_of_speech_detail_2
-                        == pos_detail.part_of_speech_detail_2
-                    )
-                    assert (
-                        word.part_of_speech_detail_3
-                        == pos_detail.part_of_speech_detail_3
-                    )
-                    assert (
-                        word.accent_associative_rule
-                        in pos_detail.accent_associative_rules
-                    )
-                    break
-            else:
+            pos_detail = _POS_BY_CONTEXT_ID.get(word.context_id)
+            if pos_detail is None:
                 raise ValueError("対応していない品詞です")
+            expected_pos = (
+                pos_detail.part_of_speech,
+                pos_detail.part_of_speech_detail_1,
+                pos_detail.part_of_speech_detail_2,
+                pos_detail.part_of_speech_detail_3,
+            )
+            word_pos = (
+                word.part_of_speech,
+                word.part_of_speech_detail_1,
+                word.part_of_speech_detail_2,
+                word.part_of_speech_detail_3,
+            )
+            if word_pos != expected_pos:
+                raise ValueError("文脈IDと品詞が一致しません")
+            if (
+                word.accent_associative_rule
+                not in _POS_RULES_BY_CONTEXT_ID[word.context_id]
+            ):
+                raise ValueError("対応していないアクセント結合規則です")
 
         # 既存辞書の読み出し
         old_dict = self.read_dict()
@@ -292,8 +527,8 @@ class UserDictionary:
             new_dict = {**dict_data, **old_dict}
 
         # 更新された辞書データの保存と適用
-        self._write_to_json(new_dict)
-        self.update_dict()
+        version = self._write_to_json(new_dict)
+        self._request_update(new_dict, version)
 
     def apply_word(self, word_property: WordProperty) -> str:
         """新規単語を追加し、その単語に割り当てられた UUID を返す。"""
@@ -303,8 +538,8 @@ class UserDictionary:
         user_dict[word_uuid] = create_word(word_property)
 
         # 更新された辞書データの保存と適用
-        self._write_to_json(user_dict)
-        self.update_dict()
+        version = self._write_to_json(user_dict)
+        self._request_update(user_dict, version)
 
         return word_uuid
 
@@ -317,8 +552,8 @@ class UserDictionary:
         user_dict[word_uuid] = create_word(word_property)
 
         # 更新された辞書データの保存と適用
-        self._write_to_json(user_dict)
-        self.update_dict()
+        version = self._write_to_json(user_dict)
+        self._request_update(user_dict, version)
 
     def delete_word(self, word_uuid: str) -> None:
         """単語UUIDで指定された単語を削除する。"""
@@ -329,5 +564,5 @@ class UserDictionary:
         del user_dict[word_uuid]
 
         # 更新された辞書データの保存と適用
-        self._write_to_json(user_dict)
-        self.update_dict()
+        version = self._write_to_json(user_dict)
+        self._request_update(user_dict, version)